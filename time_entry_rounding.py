@@ -18,30 +18,56 @@ up shortfalls in daily working hours.
 import argparse
 import base64
 import datetime
-import json
+import email.utils
+import functools
 import os
 import sys
-from datetime import date, timedelta
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
-import pytz
-import requests
-from dateutil.parser import parse
+import orjson
 from dotenv import load_dotenv
 from loguru import logger
 
+TOGGL_API_URL = "https://api.track.toggl.com/api/v9"
 
-class TimeEntryEncoder(json.JSONEncoder):
+# Number of concurrent updates sent to the Toggl API.
+MAX_WORKERS = 8
+
+# Maximum number of time entry ids Toggl accepts in one bulk PATCH request.
+BULK_PATCH_LIMIT = 100
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_iso(value):
+    """
+    Parses an RFC 3339 timestamp as returned by the Toggl API.
+    """
+    return datetime.datetime.fromisoformat(value)
+
+
+def _round_quarter(dt):
     """
-    An encoder class inheriting from JSONEncoder for serializing TimeEntry objects.
+    Truncates seconds from a datetime object and rounds it to the nearest quarter-hour.
     """
+    return _round_quarter_minutes(int(dt.timestamp()) // 60, dt.tzinfo)
 
-    # Overrides the default method to provide JSON serialization for TimeEntry and datetime objects.
-    def default(self, obj):
-        if isinstance(obj, datetime.datetime):
-            return obj.isoformat()
 
-        if isinstance(obj, TimeEntry):
-            return obj.__dict__
+@functools.lru_cache(maxsize=4096)
+def _round_quarter_minutes(minutes, tz):
+    """
+    Rounds whole minutes since the epoch to the nearest quarter-hour, so minute 7
+    rounds down and minute 8 rounds up. Cached since entries share few distinct minutes.
+    """
+    return datetime.datetime.fromtimestamp((minutes + 7) // 15 * 900, tz=tz)
+
+
+def _dump(data):
+    """
+    Serializes a payload for the Toggl API, encoding datetime objects as RFC 3339 strings.
+    """
+    return orjson.dumps(data, option=orjson.OPT_UTC_Z)
 
 
 class TimeEntry:
@@ -51,6 +77,46 @@ class TimeEntry:
     Attributes represent different aspects of a time entry such as start, stop, duration, project ID, etc.
     """
 
+    # Fields describing the time entry itself, as exchanged with the Toggl API.
+    FIELDS = (
+        "description",
+        "tags",
+        "start",
+        "stop",
+        "duration",
+        "duronly",
+        "pid",
+        "billable",
+        "guid",
+        "at",
+        "wid",
+        "id",
+        "uid",
+        "workspace_id",
+        "project_id",
+        "task_id",
+        "tag_ids",
+        "user_id",
+        "permissions",
+    )
+
+    # Fields Toggl accepts when updating a time entry; the rest are server-managed.
+    UPDATE_FIELDS = (
+        "start",
+        "stop",
+        "duration",
+        "description",
+        "tags",
+        "billable",
+        "project_id",
+        "task_id",
+        "tag_ids",
+        "workspace_id",
+    )
+
+    # The unrounded start and stop times are kept to detect entries rounding leaves unchanged.
+    __slots__ = FIELDS + ("_orig_start", "_orig_stop")
+
     # Initialization method with optional parameters for various time entry attributes.
     def __init__(
         self,
@@ -79,14 +145,9 @@ class TimeEntry:
         self.tags = tags
 
         # Process start and stop times, if provided, and calculate duration.
-        if start is not None:
-            self.start = self._round_to_quarter_hour(
-                self._truncate_seconds(parse(start))
-            )
-
-        if stop is not None:
-            self.stop = self._round_to_quarter_hour(self._truncate_seconds(parse(stop)))
-
+        self.start = _round_quarter(_parse_iso(start)) if start is not None else None
+        self.stop = _round_quarter(_parse_iso(stop)) if stop is not None else None
+        self.duration = None
         if start is not None and stop is not None:
             self.duration = (self.stop - self.start).seconds
 
@@ -101,24 +162,66 @@ class TimeEntry:
         self.workspace_id = workspace_id
         self.project_id = project_id
         self.task_id = task_id
-        self.tags_id = tag_ids
+        self.tag_ids = tag_ids
         self.user_id = user_id
+        self.permissions = permissions
+        self._orig_start = None
+        self._orig_stop = None
+
+    @classmethod
+    def from_api(cls, data):
+        """
+        Builds a TimeEntry directly from a time entry dict returned by the Toggl API,
+        reading only the fields the script uses and skipping keyword unpacking.
+        """
+        self = cls.__new__(cls)
+        self.description = data.get("description")
+        self.tags = data.get("tags")
+
+        start = data.get("start")
+        stop = data.get("stop")
+        self._orig_start = _parse_iso(start) if start is not None else None
+        self._orig_stop = _parse_iso(stop) if stop is not None else None
+        self.start = _round_quarter(self._orig_start) if start is not None else None
+        self.stop = _round_quarter(self._orig_stop) if stop is not None else None
+        self.duration = None
+        if start is not None and stop is not None:
+            self.duration = (self.stop - self.start).seconds
+
+        self.duronly = data.get("duronly")
+        self.pid = data.get("pid")
+        self.billable = data.get("billable")
+        self.guid = data.get("guid")
+        self.at = data.get("at")
+        self.wid = data.get("wid")
+        self.id = data.get("id")
+        self.uid = data.get("uid")
+        self.workspace_id = data.get("workspace_id")
+        self.project_id = data.get("project_id")
+        self.task_id = data.get("task_id")
+        self.tag_ids = data.get("tag_ids")
+        self.user_id = data.get("user_id")
+        self.permissions = data.get("permissions")
+        return self
 
     def __repr__(self):
-        return "{0}".format(self.__dict__)
+        return "{0}".format({key: getattr(self, key) for key in self.FIELDS})
 
-    def _truncate_seconds(self, dt):
+    def needs_update(self):
         """
-        Truncates seconds from a datetime object.
+        Returns True if rounding moved the start or stop time, or the entry was not fetched from Toggl.
         """
-        return dt.replace(second=0, microsecond=0)
+        return self.start != self._orig_start or self.stop != self._orig_stop
 
-    def _round_to_quarter_hour(self, dt):
+    def to_payload(self):
         """
-        Rounds a datetime object to the nearest quarter-hour.
+        Returns the updatable fields that are set on the entry, leaving out those that are None.
         """
-        round_minutes = ((dt.minute + 7) // 15) * 15
-        return dt + timedelta(minutes=round_minutes - dt.minute)
+        return {
+            key: value
+            for key in self.UPDATE_FIELDS
+            if (value := getattr(self, key)) is not None
+        }
 
 
 def get_headers():
@@ -139,72 +242,101 @@ def get_headers():
     }
 
 
+@functools.lru_cache(maxsize=1)
+def get_session():
+    """
+    Creates the HTTP session shared by every Toggl call, authenticated once with get_headers().
+    requests is imported here so that --help and a missing API key exit without loading it.
+    """
+    headers = get_headers()
+
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    # Transient Toggl failures (rate limiting, gateway errors) are retried with exponential
+    # backoff on the same connection, honoring any Retry-After header sent by the server.
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "PUT", "PATCH"]),
+        respect_retry_after_header=True,
+    )
+
+    # The session keeps connections alive between calls, and the pool is sized to the
+    # worker count so concurrent updates never wait on a socket.
+    session = requests.Session()
+    session.mount(
+        "https://api.track.toggl.com",
+        HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS, max_retries=retry),
+    )
+    session.headers.update(headers)
+    return session
+
+
 def get_time_entries(start_date=None, end_date=None):
     """
     Retrieves time entries from Toggl API within a specified date range.
     """
-    headers = get_headers()
-    url = "https://api.track.toggl.com/api/v9/me/time_entries"
+    from requests import RequestException
+
+    url = f"{TOGGL_API_URL}/me/time_entries"
     params = {}
     if start_date:
         params["start_date"] = start_date.isoformat()
     if end_date:
         params["end_date"] = end_date.isoformat()
 
-    response = requests.get(url, headers=headers, params=params)
+    try:
+        response = get_session().get(url, params=params)
+    except RequestException as exc:
+        logger.error(f"Failed to get time entries: {exc}")
+        return []
+
     if response.status_code != 200:
         logger.error(
             f"Failed to get time entries: Response: {response.status_code} - {response.text}"
         )
         return []
 
-    return [TimeEntry(**entry) for entry in response.json()]
-
-
-def get_last_time_for_day(date_string, entries):
-    """
-    Determines the latest stop time for time entries on a given date.
-    """
-    latest_time = date.min
-    target_date = parse(date_string).date()
-
-    # Obtain the latest time entry for the specified date.
-    for entry in sorted(
-        [e for e in entries if e.start.date() == target_date], key=lambda x: x.start
-    ):
-        if hasattr(entry, "stop") and entry.stop > latest_time:
-            latest_time = entry.stop
+    return [TimeEntry.from_api(entry) for entry in response.json()]
 
-    return latest_time if latest_time != date.min else None
 
-
-def get_time_per_day(entries):
+def _aggregate_by_day(entries):
     """
-    Aggregates total duration per day from a list of TimeEntry objects.
+    Aggregates total duration and latest stop time per day from a list of TimeEntry objects
+    in a single pass. Returns a dict mapping ISO dates to (seconds, latest_stop) tuples.
     """
-    time_per_day = {}
+    aggregates = {}
     for entry in entries:
+        # Running entries have no stop time and do not count towards the day yet.
+        if entry.stop is None:
+            continue
+
         day_key = entry.start.date().isoformat()
-        time_per_day[day_key] = time_per_day.get(day_key, 0) + entry.duration
-    return time_per_day
+        seconds, latest_stop = aggregates.get(day_key, (0, entry.stop))
+        aggregates[day_key] = (
+            seconds + entry.duration,
+            max(latest_stop, entry.stop),
+        )
+    return aggregates
 
 
 def fill_with_admin_time(entries):
     """
     Fills shortfall in work hours with administrative time to ensure 8 hours per day.
     """
-    time_per_day = _get_time_per_day(entries)
     admin_entries = []
     eight_hours_in_seconds = 8 * 60 * 60
 
     # Create administrative time entries where necessary.
-    for date_key, duration in time_per_day.items():
+    for duration, last_time in _aggregate_by_day(entries).values():
         if duration < eight_hours_in_seconds:
             additional_time_needed = eight_hours_in_seconds - duration
-            last_time = _get_last_time_for_day(date_key, entries)
             entry = TimeEntry(
                 start=last_time.isoformat(),
-                stop=_round_to_quarter_hour(
+                stop=_round_quarter(
                     last_time + timedelta(seconds=additional_time_needed)
                 ).isoformat(),
                 wid=876389,
@@ -216,21 +348,130 @@ def fill_with_admin_time(entries):
     return admin_entries
 
 
-def update_entries(entries):
+def _describe(exc):
     """
-    Submits updates for TimeEntry objects to the Toggl API.
+    Returns the Toggl error message for a failed request, or the exception itself
+    when no response was received.
     """
-    headers = get_headers()
+    if exc.response is not None:
+        return f"{exc.response.status_code} - {exc.response.text}"
+    return exc
 
-    for entry in entries:
-        url = f"https://api.track.toggl.com/api/v9/workspaces/{entry.workspace_id}/time_entries/{entry.id}"
-        json_data = json.dumps(entry, cls=TimeEntryEncoder)
-        response = requests.put(url, headers=headers, data=json_data)
 
-        if response.status_code != 200:
-            logger.error(f"Failed to update time: {response.text}")
+def _put_one(entry, url_prefix):
+    """
+    Submits a single TimeEntry update to the Toggl API, logging any failure.
+    """
+    from requests import RequestException
+
+    url = url_prefix + str(entry.id)
+    json_data = _dump(entry.to_payload())
+
+    # Ask Toggl to reject the update if the entry changed since it was fetched.
+    headers = {}
+    if entry.at:
+        at = _parse_iso(entry.at).astimezone(datetime.timezone.utc)
+        headers["If-Unmodified-Since"] = email.utils.format_datetime(at, usegmt=True)
+
+    try:
+        response = get_session().put(url, data=json_data, headers=headers)
+        response.raise_for_status()
+    except RequestException as exc:
+        # A failed precondition is not retried: the entry was edited elsewhere.
+        if exc.response is not None and exc.response.status_code == 412:
+            logger.debug(
+                f"Skipped time entry {entry.id}: modified since it was fetched"
+            )
+            return
+
+        logger.error(f"Failed to update time entry {entry.id}: {_describe(exc)}")
+
+
+def _patch_many(entries, url_prefix):
+    """
+    Moves several TimeEntry objects sharing the same start and stop time in a
+    single bulk PATCH request to the Toggl API, logging any failure.
+    """
+    from requests import RequestException
+
+    first = entries[0]
+    ids = ",".join(str(entry.id) for entry in entries)
+    url = url_prefix + ids
+    json_data = _dump(
+        [
+            {"op": "replace", "path": "/start", "value": first.start},
+            {"op": "replace", "path": "/stop", "value": first.stop},
+            {"op": "replace", "path": "/duration", "value": first.duration},
+        ]
+    )
+    try:
+        response = get_session().patch(url, data=json_data)
+        response.raise_for_status()
+        result = response.json()
+    except RequestException as exc:
+        logger.error(f"Failed to update time entries {ids}: {_describe(exc)}")
+        return
+
+    failures = result.get("failure") if isinstance(result, dict) else None
+    for failure in failures or []:
+        logger.error(f"Failed to update time: {failure}")
+
+
+def update_entries(entries):
+    """
+    Submits updates for TimeEntry objects to the Toggl API concurrently.
+    Entries that end up with identical start and stop times are moved in bulk
+    PATCHes of up to BULK_PATCH_LIMIT entries, the rest are updated with individual PUTs. Entries already
+    aligned to a quarter-hour are skipped.
+    """
+    changed = [entry for entry in entries if entry.needs_update()]
+    skipped = len(entries) - len(changed)
+    if skipped:
+        logger.info(f"Skipped {skipped}/{len(entries)} already quarter-aligned entries")
+
+    # Time entry URLs only differ by id within a workspace, so build each prefix once.
+    url_prefixes = {}
+    batches = defaultdict(list)
+    singles = []
+    for entry in changed:
+        if entry.workspace_id not in url_prefixes:
+            url_prefixes[entry.workspace_id] = (
+                f"{TOGGL_API_URL}/workspaces/{entry.workspace_id}/time_entries/"
+            )
+
+        if entry.start is not None and entry.stop is not None:
+            key = (entry.workspace_id, entry.start, entry.stop)
+            batches[key].append(entry)
+        else:
+            singles.append(entry)
+
+    requests_to_send = [
+        (_put_one, entry, url_prefixes[entry.workspace_id]) for entry in singles
+    ]
+    for (workspace_id, _, _), batch in batches.items():
+        url_prefix = url_prefixes[workspace_id]
+        if len(batch) == 1:
+            requests_to_send.append((_put_one, batch[0], url_prefix))
             continue
 
+        for i in range(0, len(batch), BULK_PATCH_LIMIT):
+            chunk = batch[i : i + BULK_PATCH_LIMIT]
+            requests_to_send.append((_patch_many, chunk, url_prefix))
+
+    if not requests_to_send:
+        return
+
+    # Only start as many threads as there are requests to send.
+    workers = min(MAX_WORKERS, len(requests_to_send))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(send, item, url_prefix)
+            for send, item, url_prefix in requests_to_send
+        ]
+
+    for future in futures:
+        future.result()
+
 
 def main():
     """
@@ -249,9 +490,14 @@ def main():
     # Parse command line arguments
     args = parser.parse_args()
 
-    utc_now = datetime.datetime.now(pytz.utc)
+    # Check the API key and set up the authenticated session before doing any work.
+    get_session()
+
+    utc_now = datetime.datetime.now(datetime.timezone.utc)
     date = utc_now - timedelta(days=args.number_of_days_from_today)
-    start_date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    start_date = datetime.datetime.combine(
+        date.date(), datetime.time.min, tzinfo=datetime.timezone.utc
+    )
 
     period = {"start_date": start_date, "end_date": utc_now}
     logger.info(f"Getting time entries from {start_date:%Y-%m-%d} to now")